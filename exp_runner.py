@@ -48,6 +48,7 @@ class Runner:
 
         self.igr_weight = self.conf.get_float('train.igr_weight', default=1.0)
         self.mask_weight = self.conf.get_float('train.mask_weight')
+        self.use_amp = self.conf.get_bool('train.use_amp', default=False)
         self.is_continue = is_continue
         self.mode = mode
         self.model_list = []
@@ -91,6 +92,11 @@ class Runner:
 
         if self.mode[:5] == 'train':
             self.file_backup()
+        else:
+            self.sdf_network.fuse_for_inference()
+            self.color_network.fuse_for_inference()
+            for network in (self.nerf_outside, self.sdf_network, self.deviation_network, self.color_network):
+                network.eval()
 
     def train(self):
         self.writer = SummaryWriter(log_dir=os.path.join(self.base_exp_dir, 'logs'))
@@ -266,16 +272,17 @@ class Runner:
             near, far = self.dataset.near_far_from_sphere(rays_o_batch, rays_d_batch)
             background_rgb = torch.ones([1, 3]) if self.use_white_bkgd else None
 
-            render_out = self.renderer.render(rays_o_batch,
-                                              rays_d_batch,
-                                              near,
-                                              far,
-                                              feature_maps=feature_maps,
-                                              poses=poses,
-                                              intrinsics=intrinsics,
-                                              padded_sizes=padded_sizes,
-                                              cos_anneal_ratio=self.get_cos_anneal_ratio(),
-                                              background_rgb=background_rgb)
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.use_amp):
+                render_out = self.renderer.render(rays_o_batch,
+                                                  rays_d_batch,
+                                                  near,
+                                                  far,
+                                                  feature_maps=feature_maps,
+                                                  poses=poses,
+                                                  intrinsics=intrinsics,
+                                                  padded_sizes=padded_sizes,
+                                                  cos_anneal_ratio=self.get_cos_anneal_ratio(),
+                                                  background_rgb=background_rgb)
 
             def feasible(key): return (key in render_out) and (render_out[key] is not None)
 
@@ -334,16 +341,17 @@ class Runner:
             near, far = self.dataset.near_far_from_sphere(rays_o_batch, rays_d_batch)
             background_rgb = torch.ones([1, 3]) if self.use_white_bkgd else None
 
-            render_out = self.renderer.render(rays_o_batch,
-                                              rays_d_batch,
-                                              near,
-                                              far,
-                                              feature_maps=feature_maps,
-                                              poses=poses,
-                                              intrinsics=intrinsics,
-                                              padded_sizes=padded_sizes,
-                                              cos_anneal_ratio=self.get_cos_anneal_ratio(),
-                                              background_rgb=background_rgb)
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.use_amp):
+                render_out = self.renderer.render(rays_o_batch,
+                                                  rays_d_batch,
+                                                  near,
+                                                  far,
+                                                  feature_maps=feature_maps,
+                                                  poses=poses,
+                                                  intrinsics=intrinsics,
+                                                  padded_sizes=padded_sizes,
+                                                  cos_anneal_ratio=self.get_cos_anneal_ratio(),
+                                                  background_rgb=background_rgb)
 
             out_rgb_fine.append(render_out['color_fine'].detach().cpu().numpy())
             del render_out
@@ -355,7 +363,15 @@ class Runner:
         bound_min = torch.tensor(self.dataset.object_bbox_min, dtype=torch.float32)
         bound_max = torch.tensor(self.dataset.object_bbox_max, dtype=torch.float32)
 
-        vertices, triangles = self.renderer.extract_geometry(bound_min, bound_max, resolution=resolution, threshold=threshold)
+        # Mesh extraction stays in fp32 even with use_amp: marching cubes needs full-precision SDF values.
+        # extract_fields queries full 64^3 blocks except at the upper edges of the grid, so the graph is
+        # only worth capturing for a standalone extraction that replays it over many blocks.
+        if self.mode[:5] != 'train' and resolution > 64:
+            self.sdf_network.make_cuda_graph(torch.zeros(64 ** 3, 3, device=self.device))
+        try:
+            vertices, triangles = self.renderer.extract_geometry(bound_min, bound_max, resolution=resolution, threshold=threshold)
+        finally:
+            self.sdf_network.release_cuda_graph()
         os.makedirs(os.path.join(self.base_exp_dir, 'meshes'), exist_ok=True)
 
         if world_space:
@@ -1,9 +1,128 @@
+import copy
+import math
+from collections import OrderedDict
+from typing import List
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from models.embedder import get_embedder
 
+
+class _SDFTrunk(nn.ModuleList):
+    # Holds the SDF hidden layers directly, so state_dict keys stay 'layers.<i>.*' and the
+    # whole loop can be compiled with torch.jit.script.
+    def __init__(self, skip_in: List[int], n_layers: int, beta: float):
+        super(_SDFTrunk, self).__init__()
+        self.n_layers = n_layers
+        self.is_skip: List[bool] = [l in skip_in for l in range(n_layers)]
+        self.beta = beta
+        self.skip_scale = 1.0 / math.sqrt(2)
+
+    def forward(self, x: torch.Tensor, embedded: torch.Tensor) -> torch.Tensor:
+        for l, layer in enumerate(self):
+            if self.is_skip[l]:
+                x = torch.cat([x, embedded], 1) * self.skip_scale
+            x = layer(x)
+            if l < self.n_layers - 1:
+                x = F.softplus(x, beta=self.beta)
+        return x
+
+
+class _ReLUTrunk(nn.ModuleList):
+    # Plain Linear/ReLU chain with no activation after the last layer
+    def __init__(self, n_layers: int):
+        super(_ReLUTrunk, self).__init__()
+        self.n_layers = n_layers
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        for l, lin in enumerate(self):
+            x = lin(x)
+            if l < self.n_layers - 1:
+                x = F.relu(x)
+        return x
+
+
+class _NeRFTrunk(nn.ModuleList):
+    # NeRF point layers; the skip concatenates the inputs after the activation of layer i
+    def __init__(self, skips: List[int], n_layers: int):
+        super(_NeRFTrunk, self).__init__()
+        self.skip_mask: List[bool] = [i in skips for i in range(n_layers)]
+
+    def forward(self, h: torch.Tensor, input_pts: torch.Tensor) -> torch.Tensor:
+        for i, lin in enumerate(self):
+            h = F.relu(lin(h))
+            if self.skip_mask[i]:
+                h = torch.cat([input_pts, h], -1)
+        return h
+
+
+def _plain_linear(lin):
+    # weight_norm layers hold their weight as g * v / ||v||; bake it into a fresh nn.Linear
+    with torch.no_grad():
+        if hasattr(lin, 'weight_v'):
+            weight = lin.weight_g * lin.weight_v / lin.weight_v.norm(dim=1, keepdim=True)
+        else:
+            weight = lin.weight
+        plain = nn.Linear(lin.in_features, lin.out_features, device=weight.device, dtype=weight.dtype)
+        plain.weight.copy_(weight)
+        plain.bias.copy_(lin.bias)
+    return plain
+
+
+def _script_trunk(trunk, *example_inputs):
+    # Scripts a copy with plain Linear layers, since TorchScript cannot follow the weight_norm
+    # hooks. The original trunk is never modified, so a failure cannot leave it half-converted.
+    trunk = copy.copy(trunk)
+    trunk._modules = OrderedDict((name, _plain_linear(lin)) for name, lin in trunk._modules.items())
+    trunk = torch.jit.script(trunk)
+    # Run the graph executor once per grad mode so training and inference both start warm
+    for grad_enabled in (True, False):
+        with torch.set_grad_enabled(grad_enabled), torch.jit.optimized_execution(True):
+            trunk(*example_inputs)
+    return trunk
+
+
+class CUDAGraphRunner:
+    # Captures one no-grad call of fn at fixed input shapes and replays it for matching inputs.
+    # The autocast state is part of the match, so a bf16 capture never serves fp32 callers.
+    def __init__(self, fn, *sample_inputs, n_warmup=3):
+        self.autocast_state = self._autocast_state()
+        self.static_inputs = [None if t is None else t.clone() for t in sample_inputs]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(n_warmup):
+                fn(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self.graph):
+            self.static_output = fn(*self.static_inputs)
+
+    @staticmethod
+    def _autocast_state():
+        return torch.is_autocast_enabled('cuda'), torch.get_autocast_dtype('cuda')
+
+    def matches(self, *inputs):
+        if torch.is_grad_enabled() or len(inputs) != len(self.static_inputs):
+            return False
+        if self._autocast_state() != self.autocast_state:
+            return False
+        for static, t in zip(self.static_inputs, inputs):
+            if (static is None) != (t is None):
+                return False
+            if t is not None and (t.shape != static.shape or t.dtype != static.dtype or t.device != static.device):
+                return False
+        return True
+
+    def __call__(self, *inputs):
+        for static, t in zip(self.static_inputs, inputs):
+            if static is not None:
+                static.copy_(t)
+        self.graph.replay()
+        return self.static_output.clone()
+
+
 class SDFNetwork(nn.Module):
     def __init__(self,
                  d_in,
@@ -44,9 +163,15 @@ class SDFNetwork(nn.Module):
 
         dims = [self.embedded_input_dim + feature_dim] + [d_hidden for _ in range(n_layers)] + [d_out]
         self.num_layers = len(dims)
-        self.scale = torch.tensor(scale, dtype=torch.float32).to(device) if device else torch.tensor(scale, dtype=torch.float32)
-
-        self.layers = nn.ModuleList()
+        scale_values = np.atleast_1d(np.asarray(scale, dtype=np.float32))
+        self.register_buffer('scale', torch.tensor(scale, dtype=torch.float32, device=device), persistent=False)
+        # The SDF is divided by a plain float, and the input multiply is skipped for the usual unit scale
+        self._scale0 = float(scale_values[0])
+        self._unit_scale = bool(np.all(scale_values == 1.0))
+        self.register_buffer('_zero_feat', torch.zeros(1, feature_dim, device=device), persistent=False)
+
+        self.beta = 100.0
+        self.layers = _SDFTrunk(list(skip_in), self.num_layers - 1, self.beta)
         for l in range(self.num_layers - 1):
             in_dim = dims[l]
             if l in self.skip_in:
@@ -81,31 +206,66 @@ class SDFNetwork(nn.Module):
         self.linear_k = nn.Linear(self.feature_input_dim, self.feature_input_dim)
         self.linear_fused = nn.Linear(self.feature_input_dim, self.feature_dim)
 
-        self.activation = nn.Softplus(beta=100)
+        self._cuda_graph = None
         self.to(device)
+        if not weight_norm:
+            # With weight_norm the trunk stays eager for training; fuse_for_inference scripts it
+            self._compile_trunk()
+
+    def _compile_trunk(self):
+        param = next(self.parameters())
+        x = param.new_zeros(1, self.embedded_input_dim + self.feature_dim)
+        embedded = param.new_zeros(1, self.embedded_input_dim)
+        self.layers = _script_trunk(self.layers, x, embedded)
+
+    def attention_query(self, pe):
+        # q . (W_k f + b_k) == (W_k^T q) . f + q . b_k, and q . b_k is constant over the views so it
+        # cancels in the softmax. Folding linear_k into linear_pe gives a single query head that is
+        # compared against the raw features, instead of projecting every view's features.
+        w_k = self.linear_k.weight
+        return F.linear(pe, w_k.t() @ self.linear_pe.weight, w_k.t() @ self.linear_pe.bias)
+
+    def fuse_for_inference(self):
+        # Bake g * v / ||v|| into plain weights and script the trunk once the network is frozen
+        if not isinstance(self.layers, torch.jit.ScriptModule):
+            self._compile_trunk()
+
+    def make_cuda_graph(self, inputs, features=None):
+        self._cuda_graph = None
+        self._cuda_graph = CUDAGraphRunner(self.forward, inputs, features)
+
+    def release_cuda_graph(self):
+        # Drops the graph together with its private memory pool
+        self._cuda_graph = None
 
     def forward(self, inputs, features=None):
-        inputs = inputs * self.scale
-        x = self.embed_fn_fine(inputs)
-        if features is not None:
-            x = torch.cat([x, features], dim=-1)
-        else:
-            # Concatenate zeros for features when features is None
-            zeros = torch.zeros(inputs.shape[0], self.feature_dim, device=inputs.device)
-            x = torch.cat([x, zeros], dim=-1)
-
-        for l, layer in enumerate(self.layers):
-            if l in self.skip_in:
-                x = torch.cat([x, self.embed_fn_fine(inputs)], 1) / np.sqrt(2)
-            x = layer(x)
-            if l < self.num_layers - 2:
-                x = self.activation(x)
-        return torch.cat([x[:, :1] / self.scale, x[:, 1:]], dim=-1)
+        if self._cuda_graph is not None and self._cuda_graph.matches(inputs, features):
+            return self._cuda_graph(inputs, features)
+        if not self._unit_scale:
+            inputs = inputs * self.scale
+        embedded = self.embed_fn_fine(inputs)
+        if features is None:
+            features = self._zero_feat.expand(inputs.shape[0], -1)
+        n_in = self.embedded_input_dim
+        x = embedded.new_empty(inputs.shape[0], n_in + self.feature_dim)
+        x[:, :n_in] = embedded
+        x[:, n_in:] = features
+
+        # Under autocast the trunk returns bf16; upcast so the output dtype matches the fp32 path.
+        # This does not restore precision, which is why mesh extraction runs outside autocast.
+        x = self.layers(x, embedded).float()
+        if self._scale0 != 1.0:
+            # The last Linear does not save its output for backward, so dividing in place is safe
+            x[:, 0].div_(self._scale0)
+        return x
 
     def sdf(self, x, features=None):
         return self.forward(x, features)[:, :1]
 
-    def gradient(self, x, features=None):
+    def gradient(self, x, features=None, create_graph=None):
+        # Second-order terms are only needed when the eikonal loss is being trained
+        if create_graph is None:
+            create_graph = torch.is_grad_enabled() and self.training
         x.requires_grad_(True)
         y = self.sdf(x, features)
         d_output = torch.ones_like(y, requires_grad=False, device=y.device)
@@ -113,8 +273,8 @@ class SDFNetwork(nn.Module):
             outputs=y,
             inputs=x,
             grad_outputs=d_output,
-            create_graph=True,
-            retain_graph=True,
+            create_graph=create_graph,
+            retain_graph=create_graph,
             only_inputs=True)[0]
         return gradients.unsqueeze(1)
 
@@ -138,13 +298,28 @@ class RenderingNetwork(nn.Module):
         dims = [d_in + d_feature + image_feature_dim] + [d_hidden for _ in range(n_layers)] + [d_out]
 
         self.embedview_fn = None
+        view_dim = 3
         if multires_view > 0:
             embed_fn_view, input_ch = get_embedder(multires_view)
             self.embedview_fn = embed_fn_view
             dims[0] += (input_ch - 3)
+            view_dim = input_ch
+
+        # Column ranges of (points, view_dirs, normals, feature_vectors, features) in the rendering input
+        source_ids = {'idr': (0, 1, 2, 3, 4), 'no_view_dir': (0, 2, 3, 4), 'no_normal': (0, 1, 3, 4)}
+        if mode not in source_ids:
+            raise ValueError(f"Unknown rendering mode '{mode}', expected one of {list(source_ids)}")
+        source_dims = (3, view_dim, 3, d_feature, image_feature_dim)
+        self._input_slices = []
+        start = 0
+        for i in source_ids[mode]:
+            self._input_slices.append((i, start, start + source_dims[i]))
+            start += source_dims[i]
+        self._input_dim = start
 
         self.num_layers = len(dims)
 
+        self.lins = _ReLUTrunk(self.num_layers - 1)
         for l in range(0, self.num_layers - 1):
             out_dim = dims[l + 1]
             lin = nn.Linear(dims[l], out_dim)
@@ -152,33 +327,40 @@ class RenderingNetwork(nn.Module):
             if weight_norm:
                 lin = nn.utils.weight_norm(lin)
 
-            setattr(self, "lin" + str(l), lin)
+            self.lins.append(lin)
 
-        self.relu = nn.ReLU()
+        self._register_load_state_dict_pre_hook(self._rename_legacy_keys)
         self.to(device)
+        if not weight_norm:
+            self._compile_trunk()
+
+    @staticmethod
+    def _rename_legacy_keys(state_dict, prefix, *args):
+        # Checkpoints written before the layers moved into self.lins store them as 'lin<i>.*'
+        for key in list(state_dict.keys()):
+            name = key[len(prefix):]
+            if key.startswith(prefix) and name[:3] == 'lin' and name[3:4].isdigit():
+                l, rest = name[3:].split('.', 1)
+                state_dict[prefix + 'lins.' + l + '.' + rest] = state_dict.pop(key)
+
+    def _compile_trunk(self):
+        x = next(self.parameters()).new_zeros(1, self.lins[0].in_features)
+        self.lins = _script_trunk(self.lins, x)
+
+    def fuse_for_inference(self):
+        if not isinstance(self.lins, torch.jit.ScriptModule):
+            self._compile_trunk()
 
     def forward(self, points, normals, view_dirs, feature_vectors, features):
         if self.embedview_fn is not None:
             view_dirs = self.embedview_fn(view_dirs)
 
-        rendering_input = None
-
-        if self.mode == 'idr':
-            rendering_input = torch.cat([points, view_dirs, normals, feature_vectors, features], dim=-1)
-        elif self.mode == 'no_view_dir':
-            rendering_input = torch.cat([points, normals, feature_vectors, features], dim=-1)
-        elif self.mode == 'no_normal':
-            rendering_input = torch.cat([points, view_dirs, feature_vectors, features], dim=-1)
-
-        x = rendering_input
-
-        for l in range(0, self.num_layers - 1):
-            lin = getattr(self, "lin" + str(l))
-
-            x = lin(x)
+        sources = (points, view_dirs, normals, feature_vectors, features)
+        rendering_input = points.new_empty(points.shape[0], self._input_dim)
+        for i, start, end in self._input_slices:
+            rendering_input[:, start:end] = sources[i]
 
-            if l < self.num_layers - 2:
-                x = self.relu(x)
+        x = self.lins(rendering_input)
 
         if self.squeeze_out:
             x = torch.sigmoid(x)
@@ -216,10 +398,11 @@ class NeRF(nn.Module):
             self.embed_fn_view = embed_fn_view
             self.input_ch_view = input_ch_view
 
-        self.skips = skips
+        self.skips = list(skips)
         self.use_viewdirs = use_viewdirs
 
-        self.pts_linears = nn.ModuleList(
+        self.pts_linears = _NeRFTrunk(self.skips, D)
+        self.pts_linears.extend(
             [nn.Linear(self.input_ch, W)] +
             [nn.Linear(W, W) if i not in self.skips else nn.Linear(W + self.input_ch, W) for i in range(D - 1)])
 
@@ -233,6 +416,8 @@ class NeRF(nn.Module):
             self.output_linear = nn.Linear(W, output_ch)
 
         self.to(device)
+        x = next(self.parameters()).new_zeros(1, self.input_ch)
+        self.pts_linears = _script_trunk(self.pts_linears, x, x)
 
     def forward(self, input_pts, input_views):
         if self.embed_fn is not None:
@@ -240,21 +425,15 @@ class NeRF(nn.Module):
         if self.embed_fn_view is not None:
             input_views = self.embed_fn_view(input_views)
 
-        h = input_pts
-        for i, l in enumerate(self.pts_linears):
-            h = self.pts_linears[i](h)
-            h = F.relu(h)
-            if i in self.skips:
-                h = torch.cat([input_pts, h], -1)
+        h = self.pts_linears(input_pts, input_pts)
 
         if self.use_viewdirs:
             alpha = self.alpha_linear(h)
             feature = self.feature_linear(h)
             h = torch.cat([feature, input_views], -1)
 
-            for i, l in enumerate(self.views_linears):
-                h = self.views_linears[i](h)
-                h = F.relu(h)
+            for lin in self.views_linears:
+                h = F.relu(lin(h))
 
             rgb = self.rgb_linear(h)
             return alpha, rgb
@@ -264,7 +443,8 @@ class NeRF(nn.Module):
 class SingleVarianceNetwork(nn.Module):
     def __init__(self, init_val, device=None):
         super(SingleVarianceNetwork, self).__init__()
-        self.register_parameter('variance', nn.Parameter(torch.tensor(init_val).to(device)))
+        self.register_parameter('variance', nn.Parameter(torch.tensor(float(init_val), dtype=torch.float32, device=device)))
 
     def forward(self, x):
-        return torch.ones([len(x), 1]) * torch.exp(self.variance * 10.0)
\ No newline at end of file
+        # Broadcast view on the parameter's device; callers only ever broadcast the result
+        return torch.exp(self.variance * 10.0).expand(x.shape[0], 1)
\ No newline at end of file
@@ -192,13 +192,12 @@ class NeuSRenderer:
         # Cross-attention with torch.bmm fix and debug prints
         C = features_all.shape[-1]  # e.g., 768
         pe = sdf_network.embed_fn_fine(pts.reshape(-1, 3)).reshape(batch_size, n_samples, -1)
-        query = sdf_network.linear_pe(pe)  # (batch_size, n_samples, 768)
-        keys = sdf_network.linear_k(features_all)  # (batch_size, n_samples, k, 768)
+        query = sdf_network.attention_query(pe)  # (batch_size, n_samples, 768), linear_k folded in
         values = features_all  # (batch_size, n_samples, k, 768)
 
         # Compute attention logits
         query_reshaped = query.view(batch_size * n_samples, 1, query.shape[-1])  # (b*n, 1, 768)
-        keys_reshaped = keys.view(batch_size * n_samples, k, keys.shape[-1])  # (b*n, k, 768)
+        keys_reshaped = features_all.view(batch_size * n_samples, k, C)  # (b*n, k, 768)
         attn_logits = torch.bmm(query_reshaped, keys_reshaped.transpose(1, 2))  # (b*n, 1, k)
         attn_logits = attn_logits.view(batch_size, n_samples, k) / (C ** 0.5)  # (b, n, k)
         attn = F.softmax(attn_logits, dim=-1)  # (b, n, k)
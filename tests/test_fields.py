@@ -0,0 +1,126 @@
+import pytest
+import torch
+from models.fields import SDFNetwork, RenderingNetwork, SingleVarianceNetwork, NeRF
+
+
+def make_sdf(**kwargs):
+    return SDFNetwork(d_in=3, d_out=257, d_hidden=64, n_layers=8, skip_in=[4], multires=6, **kwargs)
+
+
+def make_rendering(**kwargs):
+    return RenderingNetwork(d_feature=256, mode='idr', d_in=9, d_out=3, d_hidden=64, n_layers=4,
+                            multires_view=4, **kwargs)
+
+
+def rendering_inputs(n=16):
+    return torch.rand(n, 3), torch.rand(n, 3), torch.rand(n, 3), torch.rand(n, 256), torch.rand(n, 256)
+
+
+def test_fuse_for_inference_matches_weight_norm_output():
+    pts, features = torch.rand(16, 3), torch.rand(16, 256)
+    inputs = rendering_inputs()
+    sdf_network = make_sdf(scale=3.0)
+    color_network = make_rendering()
+    with torch.no_grad():
+        sdf_ref = sdf_network(pts, features)
+        color_ref = color_network(*inputs)
+
+    sdf_network.fuse_for_inference()
+    color_network.fuse_for_inference()
+
+    assert isinstance(sdf_network.layers, torch.jit.ScriptModule)
+    assert isinstance(color_network.lins, torch.jit.ScriptModule)
+    with torch.no_grad():
+        assert torch.allclose(sdf_network(pts, features), sdf_ref, atol=1e-5)
+        assert torch.allclose(color_network(*inputs), color_ref, atol=1e-5)
+
+
+def test_networks_without_weight_norm_are_scripted_at_construction():
+    sdf_network = make_sdf(weight_norm=False)
+    color_network = make_rendering(weight_norm=False)
+    assert isinstance(sdf_network.layers, torch.jit.ScriptModule)
+    assert isinstance(color_network.lins, torch.jit.ScriptModule)
+    sdf_network.fuse_for_inference()
+    color_network.fuse_for_inference()
+    assert sdf_network(torch.rand(4, 3)).shape == (4, 257)
+    assert color_network(*rendering_inputs(4)).shape == (4, 3)
+
+
+def test_checkpoint_load_fuse_eval():
+    # Mirrors Runner for non-train modes: build, load the checkpoint, fuse, then eval
+    trained = [NeRF(D=8, d_in=4, multires=10, multires_view=4, skips=[4], use_viewdirs=True),
+               make_sdf(), SingleVarianceNetwork(0.3), make_rendering()]
+    checkpoint = [network.state_dict() for network in trained]
+
+    nerf, sdf_network, deviation_network, color_network = \
+        [NeRF(D=8, d_in=4, multires=10, multires_view=4, skips=[4], use_viewdirs=True),
+         make_sdf(), SingleVarianceNetwork(0.3), make_rendering()]
+    for network, state_dict in zip((nerf, sdf_network, deviation_network, color_network), checkpoint):
+        network.load_state_dict(state_dict)
+    sdf_network.fuse_for_inference()
+    color_network.fuse_for_inference()
+    for network in (nerf, sdf_network, deviation_network, color_network):
+        network.eval()
+
+    pts = torch.rand(8, 3)
+    gradients = sdf_network.gradient(pts).squeeze()
+    assert gradients.shape == (8, 3)
+    with torch.no_grad():
+        assert torch.allclose(sdf_network(pts), trained[1](pts), atol=1e-5)
+        inputs = rendering_inputs(8)
+        assert torch.allclose(color_network(*inputs), trained[3](*inputs), atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs need a GPU')
+def test_cuda_graph_replays_only_for_matching_calls():
+    sdf_network = make_sdf(device=torch.device('cuda'))
+    sdf_network.fuse_for_inference()
+    sdf_network.eval()
+    pts = torch.rand(512, 3, device='cuda')
+    with torch.no_grad():
+        expected = sdf_network(pts)
+        sdf_network.make_cuda_graph(torch.zeros_like(pts))
+        assert sdf_network._cuda_graph.matches(pts, None)
+        assert torch.allclose(sdf_network(pts), expected, atol=1e-5)
+        assert not sdf_network._cuda_graph.matches(pts[:256], None)
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            assert not sdf_network._cuda_graph.matches(pts, None)
+    sdf_network.release_cuda_graph()
+    assert sdf_network._cuda_graph is None
+
+
+def test_attention_query_matches_projected_keys():
+    # Folding linear_k into the query only drops q . b_k, which is constant over the views
+    sdf_network = make_sdf().double()
+    n, k, C = 32, 4, sdf_network.feature_input_dim
+    pe = sdf_network.embed_fn_fine(torch.rand(n, 3, dtype=torch.float64))
+    features = torch.randn(n, k, C, dtype=torch.float64)
+    weights = torch.rand(n, k, dtype=torch.float64)
+
+    def attention(logits):
+        attn = torch.softmax(logits / C ** 0.5, dim=-1)
+        params = (sdf_network.linear_pe.weight, sdf_network.linear_k.weight)
+        return attn, torch.autograd.grad((attn * weights).sum(), params)
+
+    query, keys = sdf_network.linear_pe(pe), sdf_network.linear_k(features)
+    attn_ref, grads_ref = attention(torch.einsum('nc,nkc->nk', query, keys))
+    attn, grads = attention(torch.einsum('nc,nkc->nk', sdf_network.attention_query(pe), features))
+
+    assert torch.allclose(attn, attn_ref, atol=1e-10)
+    for grad, grad_ref in zip(grads, grads_ref):
+        assert torch.allclose(grad, grad_ref, atol=1e-10)
+
+
+def test_rendering_network_loads_legacy_checkpoint_keys():
+    inputs = rendering_inputs()
+    trained = make_rendering()
+    legacy = {key.replace('lins.', 'lin', 1): value for key, value in trained.state_dict().items()}
+    assert {'lin0.weight_g', 'lin0.weight_v', 'lin0.bias'} <= set(legacy)
+
+    color_network = make_rendering()
+    color_network.load_state_dict(legacy)
+    with torch.no_grad():
+        expected = trained(*inputs)
+        assert torch.allclose(color_network(*inputs), expected, atol=1e-6)
+        color_network.fuse_for_inference()
+        assert torch.allclose(color_network(*inputs), expected, atol=1e-5)